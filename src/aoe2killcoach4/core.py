@@ -1,22 +1,66 @@
 """Core parsing logic for AoE2 KillCoach v4."""
 from __future__ import annotations
-from aoe2killcoach4.time_utils import coerce_seconds
+from aoe2killcoach4.time_utils import (
+    coerce_seconds,
+    coerce_seconds_many,
+    coerce_seconds_str,
+)
 
-from dataclasses import dataclass
+import json
+import mmap
+import sys
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from dataclasses import dataclass, field
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain, compress, islice, repeat
+from operator import and_, eq, floordiv, itemgetter, le, sub
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+try:
+    import orjson
+except ImportError:  # optional: faster JSON export
+    orjson = None
 
 from aoe2killcoach4.data_mappings import (
     BUILDING_KEYS,
     COUNTER_MAP,
     GOLD_LINES,
+    LINE_IDS,
+    NON_MILITARY_LINES,
     PRODUCTION_BUILDINGS,
     TECH_CATEGORIES,
     TRASH_LINES,
     UNIT_LINE_MAP,
+    UNIT_LINES,
+    Line,
 )
 
+# Plain ints (not Line members) keep comparisons on the hot paths int-fast.
+UNKNOWN_LINE_ID = Line.unknown.value
+UNIT_LINE_IDS = {name: LINE_IDS[line] for name, line in UNIT_LINE_MAP.items()}
+VILLAGER_LINE_ID = Line.villager.value
+
+# Per-line category flags, indexed by line id.
+MILITARY_MASK = tuple(line not in NON_MILITARY_LINES for line in UNIT_LINES)
+GOLD_MASK = tuple(line in GOLD_LINES for line in UNIT_LINES)
+TRASH_MASK = tuple(line in TRASH_LINES for line in UNIT_LINES)
+
+SWITCH_IGNORED_LINES = NON_MILITARY_LINES | {"unknown"}
+
 
 @dataclass
 class ParsedReplay:
@@ -25,6 +69,14 @@ class ParsedReplay:
     data: Dict[str, Any]
 
 
+@lru_cache(maxsize=1)
+def _mgz_model() -> Any:
+    """Import mgz's model module once; it is only needed for parsing."""
+    from mgz import model
+
+    return model
+
+
 def parse_replay(path: str) -> ParsedReplay:
     """Parse a replay file into a serialized dict.
 
@@ -34,45 +86,78 @@ def parse_replay(path: str) -> ParsedReplay:
     Returns:
         ParsedReplay containing serialized match data.
     """
-    from mgz import model
+    model = _mgz_model()
 
     with open(path, "rb") as handle:
-        match = model.parse_match(handle)
+        try:
+            # Let mgz's struct reads come straight from the page cache
+            # instead of one read() syscall per field.
+            source = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # empty files, pipes, ...
+            match = model.parse_match(handle)
+        else:
+            with source:
+                match = model.parse_match(source)
     data = model.serialize(match)
     return ParsedReplay(data=data)
 
 
+@lru_cache(maxsize=None)
 def format_seconds(seconds: Optional[int]) -> Optional[str]:
+    # Inputs are whole game seconds, so the cache stays small and the same
+    # bucket/milestone values hit it across both players.
     if seconds is None:
         return None
     minutes, sec = divmod(max(0, int(seconds)), 60)
     return f"{minutes}:{sec:02d}"
 
 
+class _SanitizeTable(dict):
+    """str.translate table mapping every non-alphanumeric except - and _ to _.
+
+    isalnum() is Unicode-aware, so code points are classified on first
+    sight and cached rather than enumerated up front.
+    """
+
+    def __missing__(self, codepoint: int) -> int | str:
+        char = chr(codepoint)
+        mapped = codepoint if char.isalnum() or char in "-_" else "_"
+        self[codepoint] = mapped
+        return mapped
+
+
+_SANITIZE_TABLE = _SanitizeTable()
+
+
 def sanitize_filename(value: str) -> str:
-    safe = "".join(char if char.isalnum() or char in "-_" else "_" for char in value)
+    safe = value.translate(_SANITIZE_TABLE)
     return "_".join(filter(None, safe.split("_")))
 
 
+def _opponent_index(players: list[dict[str, Any]], idx: int) -> int:
+    # The first other player; by position, so large player dicts are never
+    # compared for equality.
+    if len(players) < 2:
+        return idx
+    return 1 if idx == 0 else 0
+
+
 def find_player(
     players: list[dict[str, Any]],
     you_name: str | None,
     you_player: int | None,
-) -> tuple[dict[str, Any], dict[str, Any]]:
+) -> tuple[int, int]:
+    """Return the (you, opponent) indices into ``players``."""
     if you_name:
-        for player in players:
-            if player.get("name", "").lower() == you_name.lower():
-                opponent = next(p for p in players if p != player)
-                return player, opponent
+        wanted = you_name.lower()
+        for idx, player in enumerate(players):
+            if player.get("name", "").lower() == wanted:
+                return idx, _opponent_index(players, idx)
     if you_player:
         idx = max(0, you_player - 1)
         if idx < len(players):
-            player = players[idx]
-            opponent = next(p for p in players if p != player)
-            return player, opponent
-    player = players[0]
-    opponent = players[1] if len(players) > 1 else players[0]
-    return player, opponent
+            return idx, _opponent_index(players, idx)
+    return 0, _opponent_index(players, 0)
 
 
 def extract_match_info(data: dict[str, Any]) -> dict[str, Any]:
@@ -86,21 +171,20 @@ def extract_match_info(data: dict[str, Any]) -> dict[str, Any]:
     return match_info
 
 
-def _action_time(action: dict[str, Any]) -> Optional[int]:
-    ts = action.get("timestamp")
-    return coerce_seconds(ts)
-
+TRAIN_ACTIONS = frozenset({"TRAIN", "DE_QUEUE", "CREATE"})
+BUILD_ACTIONS = frozenset({"BUILD"})
+RESEARCH_ACTIONS = frozenset({"RESEARCH", "DE_RESEARCH"})
+MARKET_BUY_ACTIONS = frozenset({"BUY", "DE_BUY"})
+MARKET_SELL_ACTIONS = frozenset({"SELL", "DE_SELL"})
 
-def _player_actions(data: dict[str, Any], player_index: int) -> list[dict[str, Any]]:
-    """
-    Filter actions for a given player.
+# Shared read-only stand-in for actions without a payload.
+EMPTY_PAYLOAD: dict[str, Any] = {}
 
-    Note: mgz serialize uses 1-based action["player"] values (1,2,...),
-    while our players list is 0-based. So we match on (player_index + 1).
-    """
-    actions = data.get("actions", [])
-    target = player_index + 1
-    return [action for action in actions if action.get("player") == target]
+AGE_TECHS = {
+    "Feudal Age": "Feudal",
+    "Castle Age": "Castle",
+    "Imperial Age": "Imperial",
+}
 
 
 def _unit_line(unit_name: str | None) -> str:
@@ -109,46 +193,242 @@ def _unit_line(unit_name: str | None) -> str:
     return UNIT_LINE_MAP.get(unit_name, "unknown")
 
 
-def _collect_unit_events(actions: Iterable[dict[str, Any]]) -> list[dict[str, Any]]:
-    events = []
-    for action in actions:
-        action_type = action.get("type")
-        if action_type not in {"TRAIN", "DE_QUEUE", "CREATE"}:
-            continue
-        payload = action.get("payload", {})
-        unit_name = payload.get("unit") or payload.get("name")
-        timestamp = _action_time(action)
-        if timestamp is None:
-            continue
-        events.append(
-            {
-                "time": timestamp,
-                "unit": unit_name,
-                "line": _unit_line(unit_name),
-                "object_ids": action.get("object_ids") or [],
-            }
-        )
-    return sorted(events, key=lambda item: item["time"])
+class BuildEvent(NamedTuple):
+    """Row view of one build event."""
+
+    time: int
+    building: str | None
+    object_ids: tuple[int, ...]
+
+
+class UnitEvent(NamedTuple):
+    """Row view of one unit event."""
+
+    time: int
+    unit: str | None
+    line: str
+    object_ids: tuple[int, ...]
+
+
+@dataclass(slots=True)
+class BuildEvents:
+    """Build events stored as parallel arrays (struct-of-arrays).
+
+    Object ids are ragged, so they live in one flat array: the ids of
+    event ``i`` are ``object_ids[offsets[i]:offsets[i + 1]]``. Use
+    ``rows()`` where a per-event view is needed.
+    """
+
+    times: array = field(default_factory=lambda: array("i"))
+    names: list[str | None] = field(default_factory=list)
+    object_ids: array = field(default_factory=lambda: array("i"))
+    offsets: array = field(default_factory=lambda: array("i", [0]))
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def add(self, time: int, name: str | None, object_ids: Iterable[int]) -> None:
+        self.times.append(time)
+        self.names.append(name)
+        self.object_ids.extend(object_ids)
+        self.offsets.append(len(self.object_ids))
+
+    def ids_at(self, index: int) -> array:
+        return self.object_ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def per_id(self, column: Sequence[Any]) -> Iterator[Any]:
+        """Repeat a per-event column once per object id, aligned with object_ids."""
+        counts = map(sub, islice(self.offsets, 1, None), self.offsets)
+        return chain.from_iterable(map(repeat, column, counts))
+
+    def rows(self) -> Iterator[BuildEvent]:
+        for index, (time, name) in enumerate(zip(self.times, self.names)):
+            yield BuildEvent(time, name, tuple(self.ids_at(index)))
+
+    def sort_by_time(self) -> bool:
+        """Reorder all columns by time, keeping ties in insertion order.
+
+        Replay actions are already chronological, so this is normally a
+        single monotonic check and no copy. Returns whether it reordered.
+        """
+        times = self.times
+        if all(map(le, times, islice(times, 1, None))):
+            return False
+        order = sorted(range(len(times)), key=times.__getitem__)
+        self._permute(order)
+        return True
+
+    def _permute(self, order: list[int]) -> None:
+        object_ids = array("i")
+        offsets = array("i", [0])
+        for index in order:
+            object_ids.extend(self.ids_at(index))
+            offsets.append(len(object_ids))
+        self.times = array("i", [self.times[index] for index in order])
+        self.names = [self.names[index] for index in order]
+        self.object_ids = object_ids
+        self.offsets = offsets
+
+
+@dataclass(slots=True)
+class UnitEvents(BuildEvents):
+    """Unit queue/create events; adds the interned line id of each unit."""
+
+    line_ids: array = field(default_factory=lambda: array("h"))
+
+    def add(
+        self,
+        time: int,
+        name: str | None,
+        object_ids: Iterable[int],
+        line_id: int = UNKNOWN_LINE_ID,
+    ) -> None:
+        # Explicit base call: slots=True rebuilds the class, which breaks
+        # zero-argument super().
+        BuildEvents.add(self, time, name, object_ids)
+        self.line_ids.append(line_id)
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict[str, Any]]) -> UnitEvents:
+        """Build from dict events with ``time``, ``line`` and optional ``unit``."""
+        records = list(records)
+        times = coerce_seconds_many([record["time"] for record in records])
+        events = cls()
+        for time, record in zip(times, records):
+            unit = record.get("unit")
+            events.add(
+                time,
+                unit,
+                record.get("object_ids") or [],
+                LINE_IDS.get(record.get("line") or _unit_line(unit), UNKNOWN_LINE_ID),
+            )
+        return events
+
+    def rows(self) -> Iterator[UnitEvent]:
+        for index, (time, name, line_id) in enumerate(
+            zip(self.times, self.names, self.line_ids)
+        ):
+            yield UnitEvent(time, name, UNIT_LINES[line_id], tuple(self.ids_at(index)))
 
+    def _permute(self, order: list[int]) -> None:
+        BuildEvents._permute(self, order)
+        self.line_ids = array("h", [self.line_ids[index] for index in order])
 
-def _collect_build_events(actions: Iterable[dict[str, Any]]) -> list[dict[str, Any]]:
-    builds = []
+
+def _empty_market() -> dict[str, Any]:
+    return {
+        "first_buy": None,
+        "first_buy_str": None,
+        "first_sell": None,
+        "first_sell_str": None,
+        "buy_count": 0,
+        "sell_count": 0,
+    }
+
+
+@dataclass(slots=True)
+class PlayerActions:
+    """Per-player actions classified in a single pass over the replay."""
+
+    action_times: array = field(default_factory=lambda: array("i"))
+    unit_events: UnitEvents = field(default_factory=UnitEvents)
+    build_events: BuildEvents = field(default_factory=BuildEvents)
+    market: dict[str, Any] = field(default_factory=_empty_market)
+    age_clicks: dict[str, int] = field(default_factory=dict)
+    first_unit_times: dict[str, int] = field(default_factory=dict)
+    first_building_times: dict[str, int] = field(default_factory=dict)
+    units_by_type: dict[str, int] = field(default_factory=dict)
+    units_by_line: dict[str, int] = field(default_factory=dict)
+
+
+def _classify_actions(
+    actions: Iterable[dict[str, Any]],
+    player_indices: Sequence[int],
+) -> list[PlayerActions]:
+    """
+    Partition and classify actions for several players in one pass.
+
+    Returns one PlayerActions per entry of ``player_indices``, in order.
+
+    Note: mgz serialize uses 1-based action["player"] values (1,2,...),
+    while our players list is 0-based. So we match on (player_index + 1).
+    """
+    by_target = {index + 1: PlayerActions() for index in player_indices}
+    # Interned names make the later mapping/Counter lookups identity hits.
+    intern = sys.intern
     for action in actions:
-        if action.get("type") != "BUILD":
+        get = action.get
+        player = by_target.get(get("player"))
+        if player is None:
             continue
-        payload = action.get("payload", {})
-        building = payload.get("building") or payload.get("name")
-        timestamp = _action_time(action)
-        if timestamp is None:
-            continue
-        builds.append(
-            {
-                "time": timestamp,
-                "building": building,
-                "object_ids": action.get("object_ids") or [],
-            }
-        )
-    return sorted(builds, key=lambda item: item["time"])
+        timestamp = get("timestamp")
+        timestamp_type = timestamp.__class__
+        if timestamp_type is str:
+            timestamp = coerce_seconds_str(timestamp)
+        elif timestamp_type is not int:
+            # Also maps a missing timestamp to 0, as before.
+            timestamp = coerce_seconds(timestamp)
+        player.action_times.append(timestamp)
+        action_type = get("type")
+        if action_type in TRAIN_ACTIONS:
+            payload = get("payload") or EMPTY_PAYLOAD
+            unit_name = payload.get("unit") or payload.get("name")
+            if unit_name.__class__ is str:
+                unit_name = intern(unit_name)
+            line_id = UNIT_LINE_IDS.get(unit_name, UNKNOWN_LINE_ID)
+            player.unit_events.add(
+                timestamp, unit_name, get("object_ids") or (), line_id
+            )
+            # First-seen times and totals are kept in the same pass.
+            line = UNIT_LINES[line_id]
+            firsts = player.first_unit_times
+            if line not in firsts and line_id != UNKNOWN_LINE_ID:
+                firsts[line] = timestamp
+            by_type = player.units_by_type
+            unit_key = unit_name or "unknown"
+            by_type[unit_key] = by_type.get(unit_key, 0) + 1
+            by_line = player.units_by_line
+            by_line[line] = by_line.get(line, 0) + 1
+        elif action_type in BUILD_ACTIONS:
+            payload = get("payload") or EMPTY_PAYLOAD
+            building = payload.get("building") or payload.get("name")
+            if building.__class__ is str:
+                building = intern(building)
+            player.build_events.add(timestamp, building, get("object_ids") or ())
+            key = BUILDING_KEYS.get(building)
+            if key and key not in player.first_building_times:
+                player.first_building_times[key] = timestamp
+        elif action_type in RESEARCH_ACTIONS:
+            payload = get("payload") or EMPTY_PAYLOAD
+            age = AGE_TECHS.get(payload.get("tech") or payload.get("name"))
+            if age is not None:
+                player.age_clicks[age] = timestamp
+        elif action_type in MARKET_BUY_ACTIONS:
+            market = player.market
+            if market["first_buy"] is None:
+                market["first_buy"] = timestamp
+            market["buy_count"] += 1
+        elif action_type in MARKET_SELL_ACTIONS:
+            market = player.market
+            if market["first_sell"] is None:
+                market["first_sell"] = timestamp
+            market["sell_count"] += 1
+    for player in by_target.values():
+        # Out-of-order actions: rebuild the in-pass firsts and totals from
+        # the sorted columns so they match chronological order.
+        if player.unit_events.sort_by_time():
+            player.first_unit_times = extract_first_units(player.unit_events)["times"]
+            player.units_by_type, player.units_by_line = aggregate_units(
+                player.unit_events
+            )
+        if player.build_events.sort_by_time():
+            player.first_building_times = extract_first_buildings(
+                player.build_events
+            )["times"]
+        market = player.market
+        market["first_buy_str"] = format_seconds(market["first_buy"])
+        market["first_sell_str"] = format_seconds(market["first_sell"])
+    return [by_target[index + 1] for index in player_indices]
 
 
 def _extract_uptimes(data: dict[str, Any], player_index: int) -> dict[str, Any]:
@@ -173,29 +453,12 @@ def _timing_entry(start: Optional[int], duration: Optional[int]) -> dict[str, An
     }
 
 
-def _derive_age_clicks(actions: Iterable[dict[str, Any]]) -> dict[str, int]:
-    tech_map = {
-        "Feudal Age": "Feudal",
-        "Castle Age": "Castle",
-        "Imperial Age": "Imperial",
-    }
-    starts: dict[str, int] = {}
-    for action in actions:
-        if action.get("type") not in {"RESEARCH", "DE_RESEARCH"}:
-            continue
-        payload = action.get("payload", {})
-        tech = payload.get("tech") or payload.get("name")
-        if tech in tech_map:
-            timestamp = _action_time(action)
-            if timestamp is not None:
-                starts[tech_map[tech]] = timestamp
-    return starts
-
-
-def extract_timings(data: dict[str, Any], player_index: int) -> dict[str, Any]:
+def extract_timings(
+    data: dict[str, Any],
+    player_index: int,
+    clicks: dict[str, int],
+) -> dict[str, Any]:
     uptimes = _extract_uptimes(data, player_index)
-    actions = _player_actions(data, player_index)
-    clicks = _derive_age_clicks(actions)
     durations = {"Feudal": 130, "Castle": 160, "Imperial": 190}
     timings = {
         "ages": {
@@ -206,83 +469,110 @@ def extract_timings(data: dict[str, Any], player_index: int) -> dict[str, Any]:
     return timings
 
 
-def extract_first_buildings(builds: list[dict[str, Any]]) -> dict[str, Any]:
-    firsts: dict[str, Any] = {}
-    for build in builds:
-        building = build.get("building")
-        key = BUILDING_KEYS.get(building)
-        if not key:
-            continue
-        if key not in firsts:
-            firsts[key] = build["time"]
+@dataclass(slots=True, frozen=True)
+class AgeTimes:
+    """Age-up click times in seconds; None when the age was not reached."""
+
+    feudal: int | None = None
+    castle: int | None = None
+    imperial: int | None = None
+
+    @classmethod
+    def from_timings(cls, ages: dict[str, Any]) -> AgeTimes:
+        """Build from a ``timings["ages"]`` mapping of age -> ``click_time``."""
+        def click(age: str) -> int | None:
+            return ages.get(age, {}).get("click_time")
+
+        return cls(click("Feudal"), click("Castle"), click("Imperial"))
+
+
+def _first_times(firsts: dict[str, int]) -> dict[str, Any]:
     return {
         "times": firsts,
         "times_str": {key: format_seconds(val) for key, val in firsts.items()},
     }
 
 
-def extract_first_units(unit_events: list[dict[str, Any]]) -> dict[str, Any]:
-    firsts: dict[str, int] = {}
-    for event in unit_events:
-        line = event["line"]
-        if line not in firsts and line != "unknown":
-            firsts[line] = event["time"]
-    return {
-        "times": firsts,
-        "times_str": {key: format_seconds(val) for key, val in firsts.items()},
+def extract_first_buildings(builds: BuildEvents) -> dict[str, Any]:
+    firsts: dict[str, Any] = {}
+    for time, building in zip(builds.times, builds.names):
+        key = BUILDING_KEYS.get(building)
+        if not key:
+            continue
+        if key not in firsts:
+            firsts[key] = time
+    return _first_times(firsts)
+
+
+def extract_first_units(unit_events: UnitEvents) -> dict[str, Any]:
+    first_index: dict[int, int] = {}
+    for index, line_id in enumerate(unit_events.line_ids):
+        if line_id not in first_index:
+            first_index[line_id] = index
+    first_index.pop(UNKNOWN_LINE_ID, None)
+    firsts = {
+        UNIT_LINES[line_id]: unit_events.times[index]
+        for line_id, index in first_index.items()
     }
+    return _first_times(firsts)
 
 
-def aggregate_units(unit_events: list[dict[str, Any]]) -> tuple[dict[str, int], dict[str, int]]:
-    by_type: dict[str, int] = {}
-    by_line: dict[str, int] = {}
-    for event in unit_events:
-        unit = event["unit"] or "unknown"
-        line = event["line"]
-        by_type[unit] = by_type.get(unit, 0) + 1
-        by_line[line] = by_line.get(line, 0) + 1
-    return by_type, by_line
+def aggregate_units(unit_events: UnitEvents) -> tuple[dict[str, int], dict[str, int]]:
+    by_type = Counter(unit or "unknown" for unit in unit_events.names)
+    by_line = {
+        UNIT_LINES[line_id]: count
+        for line_id, count in Counter(unit_events.line_ids).items()
+    }
+    return dict(by_type), by_line
 
 
 def snapshot_composition(
-    unit_events: list[dict[str, Any]],
+    unit_events: UnitEvents | Iterable[dict[str, Any]],
     duration: int,
-    age_times: dict[str, Any],
+    age_times: AgeTimes | dict[str, Any],
     interval: int = 300,
 ) -> list[dict[str, Any]]:
-    buckets = list(range(0, max(duration, 0) + interval, interval))
-    for age in ("Feudal", "Castle", "Imperial"):
-        time_val = age_times.get(age, {}).get("click_time")
-        if time_val is not None and time_val not in buckets:
-            buckets.append(time_val)
-    buckets = sorted(set(buckets))
+    if not isinstance(age_times, AgeTimes):
+        age_times = AgeTimes.from_timings(age_times)
+    buckets = set(range(0, max(duration, 0) + interval, interval))
+    for time_val in (age_times.feudal, age_times.castle, age_times.imperial):
+        if time_val is not None:
+            buckets.add(time_val)
     snapshots = []
-    events_sorted = sorted(unit_events, key=lambda item: item["time"])
-    idx = 0
-    totals: dict[str, int] = {}
-    for bucket in buckets:
-        while idx < len(events_sorted) and events_sorted[idx]["time"] <= bucket:
-            line = events_sorted[idx]["line"]
-            totals[line] = totals.get(line, 0) + 1
-            idx += 1
-        military_total = sum(
-            count
-            for line, count in totals.items()
-            if line not in {"villager", "fishing_ship", "trade"}
-        )
-        gold_total = sum(
-            count for line, count in totals.items() if line in GOLD_LINES
-        )
-        trash_total = sum(
-            count for line, count in totals.items() if line in TRASH_LINES
-        )
+    if not isinstance(unit_events, UnitEvents):
+        unit_events = UnitEvents.from_records(unit_events)
+        unit_events.sort_by_time()
+    times = unit_events.times
+    line_ids = unit_events.line_ids
+    counts = [0] * len(UNIT_LINES)
+    seen: list[int] = []
+    military_total = 0
+    gold_total = 0
+    trash_total = 0
+    start = 0
+    for bucket in sorted(buckets):
+        # Events are time-ordered, so each bucket only counts the new slice.
+        end = bisect_right(times, bucket, start)
+        for line_id, count in Counter(line_ids[start:end]).items():
+            if not counts[line_id]:
+                seen.append(line_id)
+            counts[line_id] += count
+            if MILITARY_MASK[line_id]:
+                military_total += count
+            if GOLD_MASK[line_id]:
+                gold_total += count
+            if TRASH_MASK[line_id]:
+                trash_total += count
+        start = end
         snapshots.append(
             {
                 "time": bucket,
                 "time_str": format_seconds(bucket),
-                "totals_by_line": dict(totals),
+                "totals_by_line": {
+                    UNIT_LINES[line_id]: counts[line_id] for line_id in seen
+                },
                 "military_total": military_total,
-                "villagers_total_proxy": totals.get("villager", 0),
+                "villagers_total_proxy": counts[VILLAGER_LINE_ID],
                 "gold_units_total": gold_total,
                 "trash_units_total": trash_total,
                 "gold_pct": (gold_total / military_total) if military_total else None,
@@ -292,35 +582,10 @@ def snapshot_composition(
     return snapshots
 
 
-def _collect_market_actions(actions: Iterable[dict[str, Any]]) -> dict[str, Any]:
-    first_buy = None
-    first_sell = None
-    buy_count = 0
-    sell_count = 0
-    for action in actions:
-        if action.get("type") in {"BUY", "DE_BUY"}:
-            timestamp = _action_time(action)
-            if timestamp is not None and first_buy is None:
-                first_buy = timestamp
-            buy_count += 1
-        if action.get("type") in {"SELL", "DE_SELL"}:
-            timestamp = _action_time(action)
-            if timestamp is not None and first_sell is None:
-                first_sell = timestamp
-            sell_count += 1
-    return {
-        "first_buy": first_buy,
-        "first_buy_str": format_seconds(first_buy),
-        "first_sell": first_sell,
-        "first_sell_str": format_seconds(first_sell),
-        "buy_count": buy_count,
-        "sell_count": sell_count,
-    }
-
-
-def _collect_farms(builds: list[dict[str, Any]]) -> dict[str, Any]:
-    farm_times = [b["time"] for b in builds if b.get("building") == "Farm"]
-    farm_times = sorted(farm_times)
+def _collect_farms(builds: BuildEvents) -> dict[str, Any]:
+    farm_times = [
+        time for time, name in zip(builds.times, builds.names) if name == "Farm"
+    ]
     milestones = {1: None, 5: None, 10: None}
     for count in milestones:
         if len(farm_times) >= count:
@@ -340,117 +605,168 @@ def _collect_farms(builds: list[dict[str, Any]]) -> dict[str, Any]:
     }
 
 
+AGE_LABELS = ("Dark", "Feudal", "Castle", "Imperial")
+
+
+def _window_overlap(starts: array, ends: array, lo: int, hi: int) -> int:
+    """Total overlap of the gaps ``[starts[i], ends[i])`` with ``[lo, hi)``."""
+    # Equivalent to summing max(0, min(end, hi) - max(start, lo)) per gap,
+    # with every step mapped over the whole buffer in C.
+    clipped = map(sub, map(min, ends, repeat(hi)), map(max, starts, repeat(lo)))
+    return sum(map(max, clipped, repeat(0)))
+
+
+def _age_windows(
+    age_times: AgeTimes,
+    duration: int,
+) -> tuple[tuple[int, int], ...]:
+    """Resolve the (start, end) window of each of AGE_LABELS.
+
+    A missing click opens its window at 0 and closes the previous one at
+    the end of the game.
+    """
+    feudal_t = age_times.feudal
+    castle_t = age_times.castle
+    imp_t = age_times.imperial
+    windows = ((0, feudal_t), (feudal_t, castle_t), (castle_t, imp_t), (imp_t, duration))
+    return tuple(
+        (0 if start is None else start, duration if end is None else end)
+        for start, end in windows
+    )
+
+
+def _tc_idle_kernel(
+    queue_keys: Sequence[int],
+    times: Sequence[int],
+    duration: int,
+    windows: tuple[tuple[int, int], ...],
+) -> tuple[int, list[int]]:
+    """Scan villager queue times for town center idle gaps.
+
+    ``queue_keys`` and ``times`` are parallel and sorted by (key, time);
+    each run of equal keys is one town center's queue. Returns the idle
+    total and its split over ``windows`` (see _age_windows).
+    """
+    starts = array("i")
+    ends = array("i")
+    last_key = None
+    last_time = 0
+    for key, time in zip(queue_keys, times):
+        if key != last_key:
+            if last_time and duration > last_time + 25:
+                starts.append(last_time + 25)
+                ends.append(duration)
+            last_key = key
+            last_time = 0
+        if time - last_time - 25 > 5:
+            starts.append(last_time + 25)
+            ends.append(time)
+        last_time = time
+    if last_time and duration > last_time + 25:
+        starts.append(last_time + 25)
+        ends.append(duration)
+
+    per_age = [_window_overlap(starts, ends, lo, hi) for lo, hi in windows]
+    # Every recorded gap has end > start, so the total needs no clamping.
+    return sum(ends) - sum(starts), per_age
+
+
 def _collect_tc_idle(
-    unit_events: list[dict[str, Any]],
-    builds: list[dict[str, Any]],
+    unit_events: UnitEvents,
+    builds: BuildEvents,
     duration: int,
-    age_times: dict[str, Any],
+    age_times: AgeTimes,
 ) -> tuple[dict[str, Any], bool]:
-    villager_events = [e for e in unit_events if e["line"] == "villager"]
-    villager_events = sorted(villager_events, key=lambda item: item["time"])
-    tc_builds = [b for b in builds if b.get("building") == "Town Center"]
-    tc_ids = {obj_id for b in tc_builds for obj_id in b.get("object_ids", [])}
+    tc_ids = {
+        obj_id
+        for index, name in enumerate(builds.names)
+        if name == "Town Center"
+        for obj_id in builds.ids_at(index)
+    }
     had_ids = bool(tc_ids)
-    idle_total = 0
-    per_age = {"Dark": 0, "Feudal": 0, "Castle": 0, "Imperial": 0}
-
-    def add_idle(start: int, end: int) -> None:
-        nonlocal idle_total
-        gap = max(0, end - start)
-        idle_total += gap
-        age_bounds = [
-            ("Dark", 0, age_times["Feudal"]["click_time"]),
-            ("Feudal", age_times["Feudal"]["click_time"], age_times["Castle"]["click_time"]),
-            ("Castle", age_times["Castle"]["click_time"], age_times["Imperial"]["click_time"]),
-            ("Imperial", age_times["Imperial"]["click_time"], duration),
-        ]
-        for label, start_age, end_age in age_bounds:
-            if start_age is None:
-                start_age = 0
-            if end_age is None:
-                end_age = duration
-            overlap = max(0, min(end, end_age) - max(start, start_age))
-            per_age[label] += overlap
 
     if had_ids:
-        events_by_tc: dict[int, list[int]] = {tc_id: [] for tc_id in tc_ids}
-        for event in villager_events:
-            for obj_id in event.get("object_ids", []):
-                if obj_id in events_by_tc:
-                    events_by_tc[obj_id].append(event["time"])
-        for times in events_by_tc.values():
-            times = sorted(times)
-            last_time = 0
-            for time in times:
-                gap = time - last_time - 25
-                if gap > 5:
-                    add_idle(last_time + 25, time)
-                last_time = time
-            if last_time and duration > last_time + 25:
-                add_idle(last_time + 25, duration)
+        # One (object id, time) row per queued id, kept when the event is a
+        # villager and the id is a town center; filtered without a Python
+        # loop. Events are time-ordered, so a stable sort on the TC id alone
+        # keeps each queue's times in order.
+        object_ids = unit_events.object_ids
+        is_villager = map(
+            eq, unit_events.per_id(unit_events.line_ids), repeat(VILLAGER_LINE_ID)
+        )
+        keep = map(and_, is_villager, map(tc_ids.__contains__, object_ids))
+        rows = compress(zip(object_ids, unit_events.per_id(unit_events.times)), keep)
+        pairs = sorted(rows, key=itemgetter(0))
+        queue_keys = array("i", map(itemgetter(0), pairs))
+        times = array("i", map(itemgetter(1), pairs))
     else:
-        last_time = 0
-        for event in villager_events:
-            time = event["time"]
-            gap = time - last_time - 25
-            if gap > 5:
-                add_idle(last_time + 25, time)
-            last_time = time
-        if last_time and duration > last_time + 25:
-            add_idle(last_time + 25, duration)
+        # Without town center ids, treat all villager queues as one.
+        is_villager = map(eq, unit_events.line_ids, repeat(VILLAGER_LINE_ID))
+        times = array("i", compress(unit_events.times, is_villager))
+        queue_keys = array("i", [0]) * len(times)
 
+    idle_total, per_age = _tc_idle_kernel(
+        queue_keys, times, duration, _age_windows(age_times, duration)
+    )
     return {
         "total": idle_total,
         "total_str": format_seconds(idle_total),
-        "by_age": per_age,
+        "by_age": dict(zip(AGE_LABELS, per_age)),
     }, not had_ids
 
 
+def _production_idle_kernel(
+    times: Sequence[int],
+    start: int,
+    duration: int,
+    idle_threshold: int,
+) -> list[tuple[int, int]]:
+    """Return (start, length) of each production gap over the threshold."""
+    gaps = []
+    last_time = start
+    for time in times:
+        if time - last_time > idle_threshold:
+            gaps.append((last_time, time - last_time))
+        last_time = time
+    if duration - last_time > idle_threshold:
+        gaps.append((last_time, duration - last_time))
+    return gaps
+
+
 def _collect_production_idle_flags(
-    unit_events: list[dict[str, Any]],
-    builds: list[dict[str, Any]],
+    unit_events: UnitEvents,
+    builds: BuildEvents,
     duration: int,
     idle_threshold: int = 60,
 ) -> tuple[list[dict[str, Any]], bool]:
     events_by_id: dict[int, list[int]] = {}
-    for event in unit_events:
-        for obj_id in event.get("object_ids", []):
-            events_by_id.setdefault(obj_id, []).append(event["time"])
+    id_times = unit_events.per_id(unit_events.times)
+    for obj_id, time in zip(unit_events.object_ids, id_times):
+        events_by_id.setdefault(obj_id, []).append(time)
     flags: list[dict[str, Any]] = []
     missing_ids = False
-    for build in builds:
-        building = build.get("building")
+    for index, building in enumerate(builds.names):
         if building not in PRODUCTION_BUILDINGS:
             continue
-        if not build.get("object_ids"):
+        build_ids = builds.ids_at(index)
+        if not build_ids:
             missing_ids = True
             continue
-        for obj_id in build.get("object_ids", []):
-            times = sorted(events_by_id.get(obj_id, []))
-            last_time = build["time"]
-            for time in times:
-                if time - last_time > idle_threshold:
-                    flags.append(
-                        {
-                            "building": building,
-                            "object_id": obj_id,
-                            "start": last_time,
-                            "duration": time - last_time,
-                        }
-                    )
-                last_time = time
-            if duration - last_time > idle_threshold:
-                flags.append(
-                    {
-                        "building": building,
-                        "object_id": obj_id,
-                        "start": last_time,
-                        "duration": duration - last_time,
-                    }
+        for obj_id in build_ids:
+            times = events_by_id.get(obj_id, [])
+            flags.extend(
+                {
+                    "building": building,
+                    "object_id": obj_id,
+                    "start": start,
+                    "duration": length,
+                    "start_str": format_seconds(start),
+                    "duration_str": format_seconds(length),
+                }
+                for start, length in _production_idle_kernel(
+                    times, builds.times[index], duration, idle_threshold
                 )
-    for flag in flags:
-        flag["start_str"] = format_seconds(flag["start"])
-        flag["duration_str"] = format_seconds(flag["duration"])
+            )
     return flags, missing_ids
 
 
@@ -463,9 +779,9 @@ def _detect_switches(
     missed: list[dict[str, Any]] = []
     for prev, curr in zip(opponent_snapshots, opponent_snapshots[1:]):
         for line, count in curr["totals_by_line"].items():
-            prev_count = prev["totals_by_line"].get(line, 0)
-            if line in {"villager", "fishing_ship", "trade", "unknown"}:
+            if line in SWITCH_IGNORED_LINES:
                 continue
+            prev_count = prev["totals_by_line"].get(line, 0)
             if count - prev_count >= 5 and prev_count <= 2:
                 switch_events.append(
                     {
@@ -514,20 +830,54 @@ def _detect_switches(
     }
 
 
-def _actions_per_minute(actions: list[dict[str, Any]], duration: int) -> list[dict[str, Any]]:
+def _actions_per_minute(action_times: array, duration: int) -> list[dict[str, Any]]:
     bins = [0] * (max(duration, 0) // 60 + 1)
-    for action in actions:
-        ts = _action_time(action)
-        if ts is None:
-            continue
-        index = min(ts // 60, len(bins) - 1)
-        bins[index] += 1
+    last = len(bins) - 1
+    for minute, count in Counter(map(floordiv, action_times, repeat(60))).items():
+        bins[min(minute, last)] += count
     return [
         {"minute": idx, "actions": count}
         for idx, count in enumerate(bins)
     ]
 
 
+@dataclass(slots=True)
+class PlayerReport:
+    """Per-player analysis derived from that player's classified actions."""
+
+    timings: dict[str, Any]
+    snapshots: list[dict[str, Any]]
+    farms: dict[str, Any]
+    tc_idle: dict[str, Any]
+    tc_missing: bool
+    idle_flags: list[dict[str, Any]]
+    prod_missing: bool
+
+
+def _analyze_side(
+    data: dict[str, Any],
+    player_index: int,
+    classified: PlayerActions,
+    duration: int,
+) -> PlayerReport:
+    """Run the per-player pipeline; it shares no state with the other side."""
+    units = classified.unit_events
+    builds = classified.build_events
+    timings = extract_timings(data, player_index, classified.age_clicks)
+    age_times = AgeTimes.from_timings(timings["ages"])
+    tc_idle, tc_missing = _collect_tc_idle(units, builds, duration, age_times)
+    idle_flags, prod_missing = _collect_production_idle_flags(units, builds, duration)
+    return PlayerReport(
+        timings=timings,
+        snapshots=snapshot_composition(units, duration, age_times),
+        farms=_collect_farms(builds),
+        tc_idle=tc_idle,
+        tc_missing=tc_missing,
+        idle_flags=idle_flags,
+        prod_missing=prod_missing,
+    )
+
+
 def analyze_replay(
     data: dict[str, Any],
     you_name: str | None,
@@ -537,9 +887,9 @@ def analyze_replay(
     players = data.get("players", [])
     if len(players) < 1:
         raise ValueError("No players found in replay data.")
-    you, opponent = find_player(players, you_name, you_player)
-    you_index = players.index(you)
-    opp_index = players.index(opponent)
+    you_index, opp_index = find_player(players, you_name, you_player)
+    you = players[you_index]
+    opponent = players[opp_index]
 
     match_info = extract_match_info(data)
     # Avoid bloating outputs with custom-map tile grids
@@ -550,106 +900,67 @@ def analyze_replay(
         match_info['map'] = m
     duration = coerce_seconds(match_info.get("duration") or 0) or 0
 
-    you_actions = _player_actions(data, you_index)
-    opp_actions = _player_actions(data, opp_index)
-    you_units = _collect_unit_events(you_actions)
-    opp_units = _collect_unit_events(opp_actions)
-    you_builds = _collect_build_events(you_actions)
-    opp_builds = _collect_build_events(opp_actions)
-
-    you_timings = extract_timings(data, you_index)
-    opp_timings = extract_timings(data, opp_index)
-
-    you_first_buildings = extract_first_buildings(you_builds)
-    opp_first_buildings = extract_first_buildings(opp_builds)
-
-    you_first_units = extract_first_units(you_units)
-    opp_first_units = extract_first_units(opp_units)
-
-    you_units_by_type, you_units_by_line = aggregate_units(you_units)
-    opp_units_by_type, opp_units_by_line = aggregate_units(opp_units)
-
-    you_snapshots = snapshot_composition(
-        you_units, duration, you_timings["ages"]
-    )
-    opp_snapshots = snapshot_composition(
-        opp_units, duration, opp_timings["ages"]
-    )
-
-    you_farms = _collect_farms(you_builds)
-    opp_farms = _collect_farms(opp_builds)
-
-    you_market = _collect_market_actions(you_actions)
-    opp_market = _collect_market_actions(opp_actions)
-
-    you_tc_idle, you_tc_missing = _collect_tc_idle(
-        you_units, you_builds, duration, you_timings["ages"]
-    )
-    opp_tc_idle, opp_tc_missing = _collect_tc_idle(
-        opp_units, opp_builds, duration, opp_timings["ages"]
-    )
-
-    you_idle_flags, you_prod_missing = _collect_production_idle_flags(
-        you_units, you_builds, duration
-    )
-    opp_idle_flags, opp_prod_missing = _collect_production_idle_flags(
-        opp_units, opp_builds, duration
+    actions = data.get("actions", [])
+    you_classified, opp_classified = _classify_actions(
+        actions, (you_index, opp_index)
     )
+    you_report = _analyze_side(data, you_index, you_classified, duration)
+    opp_report = _analyze_side(data, opp_index, opp_classified, duration)
 
-    counters = _detect_switches(opp_snapshots, you_snapshots)
+    counters = _detect_switches(opp_report.snapshots, you_report.snapshots)
 
     warnings = [
         "Cancellations and build destructions are not tracked.",
     ]
-    if you_tc_missing or opp_tc_missing:
+    if you_report.tc_missing or opp_report.tc_missing:
         warnings.append(
             "Missing object IDs for some queue events; idle times estimated overall."
         )
-    if you_prod_missing or opp_prod_missing:
+    if you_report.prod_missing or opp_report.prod_missing:
         warnings.append(
             "Missing object IDs for some production buildings; idle flags may be incomplete."
         )
 
     coach_view = {
         "timings": {
-            "you": you_timings,
-            "opponent": opp_timings,
+            "you": you_report.timings,
+            "opponent": opp_report.timings,
         },
         "first_buildings": {
-            "you": you_first_buildings,
-            "opponent": opp_first_buildings,
+            "you": _first_times(you_classified.first_building_times),
+            "opponent": _first_times(opp_classified.first_building_times),
         },
         "first_units": {
-            "you": you_first_units,
-            "opponent": opp_first_units,
+            "you": _first_times(you_classified.first_unit_times),
+            "opponent": _first_times(opp_classified.first_unit_times),
         },
         "units": {
             "you": {
-                "created_totals_by_type": you_units_by_type,
-                "created_totals_by_line": you_units_by_line,
-                "composition_snapshots": you_snapshots,
+                "created_totals_by_type": you_classified.units_by_type,
+                "created_totals_by_line": you_classified.units_by_line,
+                "composition_snapshots": you_report.snapshots,
             },
             "opponent": {
-                "created_totals_by_type": opp_units_by_type,
-                "created_totals_by_line": opp_units_by_line,
-                "composition_snapshots": opp_snapshots,
+                "created_totals_by_type": opp_classified.units_by_type,
+                "created_totals_by_line": opp_classified.units_by_line,
+                "composition_snapshots": opp_report.snapshots,
             },
         },
         "eco_health": {
             "you": {
-                "tc_idle_time": you_tc_idle,
-                "farms": you_farms,
-                "market": you_market,
+                "tc_idle_time": you_report.tc_idle,
+                "farms": you_report.farms,
+                "market": you_classified.market,
             },
             "opponent": {
-                "tc_idle_time": opp_tc_idle,
-                "farms": opp_farms,
-                "market": opp_market,
+                "tc_idle_time": opp_report.tc_idle,
+                "farms": opp_report.farms,
+                "market": opp_classified.market,
             },
         },
         "production": {
-            "you": {"idle_flags": you_idle_flags},
-            "opponent": {"idle_flags": opp_idle_flags},
+            "you": {"idle_flags": you_report.idle_flags},
+            "opponent": {"idle_flags": opp_report.idle_flags},
         },
         "counters": {
             "you": counters,
@@ -664,8 +975,8 @@ def analyze_replay(
 
     raw_section = {
         "actions_per_minute": {
-            "you": _actions_per_minute(you_actions, duration),
-            "opponent": _actions_per_minute(opp_actions, duration),
+            "you": _actions_per_minute(you_classified.action_times, duration),
+            "opponent": _actions_per_minute(opp_classified.action_times, duration),
         }
     }
 
@@ -695,13 +1006,22 @@ def analyze_replay(
     return result
 
 
-def build_prompt(match: dict[str, Any], players: dict[str, Any]) -> str:
-    you = players["you"]
-    opp = players["opponent"]
+# Part of the prompt cache key; bump whenever the template below changes.
+PROMPT_VERSION = 1
+
+
+@lru_cache(maxsize=4096)
+def _build_prompt_impl(
+    version: int,
+    map_name: str,
+    civ_you: str,
+    civ_opp: str,
+    you_won: bool,
+) -> str:
     summary = (
-        f"Map: {match.get('map')}. "
-        f"You ({you.get('civilization')}) vs {opp.get('civilization')}. "
-        f"Result: {'Win' if you.get('winner') else 'Loss'}."
+        f"Map: {map_name}. "
+        f"You ({civ_you}) vs {civ_opp}. "
+        f"Result: {'Win' if you_won else 'Loss'}."
     )
     return (
         "# AoE2 KillCoach v4 Prompt\n\n"
@@ -714,6 +1034,20 @@ def build_prompt(match: dict[str, Any], players: dict[str, Any]) -> str:
     )
 
 
+def build_prompt(match: dict[str, Any], players: dict[str, Any]) -> str:
+    you = players["you"]
+    opp = players["opponent"]
+    # Only hashable scalars reach the cache; str() matches the f-string
+    # rendering, including custom-map dicts.
+    return _build_prompt_impl(
+        PROMPT_VERSION,
+        str(match.get("map")),
+        str(you.get("civilization")),
+        str(opp.get("civilization")),
+        bool(you.get("winner")),
+    )
+
+
 def build_tsv_row(result: dict[str, Any]) -> tuple[list[str], list[str]]:
     match = result["match"]
     you = result["players"]["you"]
@@ -759,6 +1093,9 @@ def build_tsv_row(result: dict[str, Any]) -> tuple[list[str], list[str]]:
     return columns, row
 
 
+WRITE_BUFFER_SIZE = 1 << 20
+
+
 def write_outputs(
     result: dict[str, Any],
     out_dir: Path,
@@ -784,17 +1121,27 @@ def write_outputs(
     prompt_path = out_dir / f"{friendly}.prompt.md"
     tsv_path = out_dir / "aoe2killcoach_stats.tsv"
 
-    json_path.write_text(
-        __import__("json").dumps(result, indent=2, ensure_ascii=False)
-    )
+    if orjson is not None:
+        json_bytes = orjson.dumps(
+            result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        )
+        with open(json_path, "wb", buffering=WRITE_BUFFER_SIZE) as handle:
+            handle.write(json_bytes)
+    else:
+        # json.dump emits many small chunks; a large buffer batches them.
+        with open(
+            json_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE
+        ) as handle:
+            json.dump(result, handle, indent=2, ensure_ascii=False)
     prompt_path.write_text(build_prompt(match, players))
 
     columns, row = build_tsv_row(result)
     write_header = tsv_mode == "header-row" or not tsv_path.exists()
+    tsv_payload = "\t".join(row) + "\n"
+    if write_header:
+        tsv_payload = "\t".join(columns) + "\n" + tsv_payload
     with tsv_path.open("a", encoding="utf-8") as handle:
-        if write_header:
-            handle.write("\t".join(columns) + "\n")
-        handle.write("\t".join(row) + "\n")
+        handle.write(tsv_payload)
 
     return {
         "json": json_path,
@@ -1,6 +1,9 @@
 """Static mapping data for units and counters."""
 from __future__ import annotations
 
+import sys
+from enum import IntEnum
+
 UNIT_LINE_MAP = {
     # Economy
     "Villager": "villager",
@@ -183,6 +186,12 @@ UNIT_LINE_MAP = {
     "Siege Elephant": "siege",
 }
 
+# Stable integer ids for unit lines, used by the array-backed event stores.
+UNIT_LINES = tuple(sorted(set(UNIT_LINE_MAP.values()) | {"unknown"}))
+# Named view of the line ids; Line.villager == LINE_IDS["villager"].
+Line = IntEnum("Line", [(line, idx) for idx, line in enumerate(UNIT_LINES)])
+LINE_IDS = {line.name: line.value for line in Line}
+
 TECH_CATEGORIES = {
     "Loom": "eco",
     "Double-Bit Axe": "eco",
@@ -270,6 +279,8 @@ GOLD_LINES = {
 
 TRASH_LINES = {"skirm_line", "spear_line"}
 
+NON_MILITARY_LINES = frozenset({"villager", "fishing_ship", "trade"})
+
 PRODUCTION_BUILDINGS = {
     "Barracks",
     "Archery Range",
@@ -293,3 +304,9 @@ BUILDING_KEYS = {
     "Castle": "castle",
     "Town Center": "town_center",
 }
+
+# Replay unit/building names are interned on parse; intern the keys they
+# are looked up against too (names with spaces are not interned by default).
+UNIT_LINE_MAP = {sys.intern(name): line for name, line in UNIT_LINE_MAP.items()}
+PRODUCTION_BUILDINGS = {sys.intern(name) for name in PRODUCTION_BUILDINGS}
+BUILDING_KEYS = {sys.intern(name): key for name, key in BUILDING_KEYS.items()}
@@ -1,31 +1,58 @@
 """Utilities for parsing time values."""
-from __future__ import annotations
+import re
+from array import array
+from collections.abc import Iterable
+from functools import lru_cache
 
-from typing import Any
+# [h:]mm:ss[.fff]; anchored via fullmatch, so signs and inner spaces are rejected.
+# Fields are non-negative, so truncating drops the fraction; it is not captured.
+_CLOCK_RE = re.compile(r"(?:(\d+):)?(\d+):(\d+)(?:\.\d+)?")
 
 
-def coerce_seconds(value: Any) -> int:
-    """Coerce common replay time formats into whole seconds."""
-    if value is None:
-        return 0
-    if isinstance(value, (int, float)):
-        return int(value)
-    if isinstance(value, str):
-        stripped = value.strip()
+@lru_cache(maxsize=1 << 15)
+def coerce_seconds_str(value: str) -> int:
+    """Parse a replay time string; cached because the same clock strings recur."""
+    stripped = value.strip()
+    if ":" not in stripped:
         if not stripped:
             return 0
-        if stripped.replace(".", "", 1).isdigit():
+        try:
             return int(float(stripped))
-        parts = stripped.split(":")
-        if len(parts) in {2, 3}:
-            hours = 0
-            if len(parts) == 3:
-                hours = int(parts[0])
-                minutes = int(parts[1])
-                seconds = float(parts[2])
-            else:
-                minutes = int(parts[0])
-                seconds = float(parts[1])
-            total = hours * 3600 + minutes * 60 + seconds
-            return int(total)
+        except (ValueError, OverflowError):
+            raise ValueError(f"Unsupported time format: {value!r}") from None
+    match = _CLOCK_RE.fullmatch(stripped)
+    if match is not None:
+        hours, minutes, seconds = match.groups()
+        total = int(minutes) * 60 + int(seconds)
+        return int(hours) * 3600 + total if hours else total
     raise ValueError(f"Unsupported time format: {value!r}")
+
+
+# The underscore defaults below are deliberate: they bind the builtins as
+# locals (LOAD_FAST) on these per-event paths. Callers never pass them.
+# isinstance stays the builtin so type checkers (and mypyc) can narrow on it.
+
+
+def coerce_seconds_num(value: int | float | None, _type=type, _int=int) -> int:
+    """Coerce a numeric (or missing) time value into whole seconds."""
+    if value is None:
+        return 0
+    if _type(value) is _int:
+        return value  # type: ignore[return-value]  # exact int, not narrowed
+    return _int(value)
+
+
+def coerce_seconds(value: object, _type=type, _int=int) -> int:
+    """Coerce common replay time formats into whole seconds."""
+    if _type(value) is _int:
+        return value  # type: ignore[return-value]  # exact int, not narrowed
+    if isinstance(value, str):
+        return coerce_seconds_str(value)
+    if value is None or isinstance(value, (int, float)):
+        return coerce_seconds_num(value)
+    raise ValueError(f"Unsupported time format: {value!r}")
+
+
+def coerce_seconds_many(values: Iterable[object]) -> array:
+    """Coerce a batch of time values into a compact ``array('i')``."""
+    return array("i", map(coerce_seconds, values))
@@ -1,21 +1,74 @@
+import json
+
+import pytest
+
+from aoe2killcoach4 import core
 from aoe2killcoach4.core import (
+    AgeTimes,
+    UnitEvent,
+    UnitEvents,
+    analyze_replay,
     build_prompt,
     build_tsv_row,
+    find_player,
     format_seconds,
     sanitize_filename,
     snapshot_composition,
+    write_outputs,
+)
+from aoe2killcoach4.time_utils import (
+    coerce_seconds,
+    coerce_seconds_num,
+    coerce_seconds_str,
 )
 
 
-def test_format_seconds():
-    assert format_seconds(None) is None
-    assert format_seconds(0) == "0:00"
-    assert format_seconds(125) == "2:05"
+@pytest.mark.parametrize(
+    "seconds, expected",
+    [(None, None), (0, "0:00"), (125, "2:05")],
+)
+def test_format_seconds(seconds, expected):
+    assert format_seconds(seconds) == expected
+
+
+def test_coerce_seconds():
+    assert coerce_seconds(None) == 0
+    assert coerce_seconds(90) == 90
+    assert coerce_seconds(12.9) == 12
+    assert coerce_seconds("  ") == 0
+    assert coerce_seconds("42.5") == 42
+    assert coerce_seconds("10:00") == 600
+    assert coerce_seconds("1:02:03.75") == 3723
+    assert coerce_seconds(" 10:00 ") == 600
+    with pytest.raises(ValueError):
+        coerce_seconds("soon")
+    with pytest.raises(ValueError):
+        coerce_seconds("1:-5")
+    with pytest.raises(ValueError):
+        coerce_seconds([1])
+    assert coerce_seconds_str("0:27:59.757000") == 1679
+    assert coerce_seconds_num(None) == 0
+    assert coerce_seconds_num(59.9) == 59
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("Arabia vs. Arena", "Arabia_vs_Arena"),
+        ("a/b:c", "a_b_c"),
+        ("Ñandú—2024 (ranked)!", "Ñandú_2024_ranked"),
+    ],
+)
+def test_sanitize_filename(value, expected):
+    assert sanitize_filename(value) == expected
 
 
-def test_sanitize_filename():
-    assert sanitize_filename("Arabia vs. Arena") == "Arabia_vs_Arena"
-    assert sanitize_filename("a/b:c") == "a_b_c"
+def test_find_player_returns_indices():
+    players = [{"name": "Alpha"}, {"name": "Beta"}]
+    assert find_player(players, "beta", None) == (1, 0)
+    assert find_player(players, None, 1) == (0, 1)
+    assert find_player(players, "nobody", None) == (0, 1)
+    assert find_player(players[:1], None, None) == (0, 0)
 
 
 def test_snapshot_composition_basic():
@@ -36,6 +89,21 @@ def test_snapshot_composition_basic():
     assert mid["totals_by_line"]["villager"] == 1
     assert mid["totals_by_line"]["archer_line"] == 1
     assert end["totals_by_line"]["archer_line"] == 2
+    assert snapshot_composition(events, duration, AgeTimes(feudal=130)) == snapshots
+
+
+def test_unit_events_sorted_rows():
+    events = UnitEvents.from_records(
+        [
+            {"time": "0:30", "unit": "Archer", "line": "archer_line", "object_ids": [7]},
+            {"time": 10, "unit": "Villager", "line": "villager", "object_ids": [1, 2]},
+        ]
+    )
+    events.sort_by_time()
+    assert list(events.rows()) == [
+        UnitEvent(10, "Villager", "villager", (1, 2)),
+        UnitEvent(30, "Archer", "archer_line", (7,)),
+    ]
 
 
 def test_build_prompt_and_tsv_row():
@@ -77,3 +145,55 @@ def test_build_prompt_and_tsv_row():
     columns, row = build_tsv_row(result)
     assert columns[0] == "timestamp"
     assert row[4] == "Franks"
+
+
+def test_analyze_replay_classifies_actions():
+    data = {
+        "players": [
+            {"name": "You", "civilization": "Franks", "winner": True},
+            {"name": "Opp", "civilization": "Britons", "winner": False},
+        ],
+        "duration": 600,
+        "actions": [
+            {"type": "TRAIN", "player": 1, "timestamp": "0:00:05",
+             "payload": {"unit": "Villager"}, "object_ids": [1]},
+            {"type": "BUILD", "player": 1, "timestamp": "0:01:00",
+             "payload": {"building": "Barracks"}, "object_ids": [2]},
+            {"type": "RESEARCH", "player": 1, "timestamp": "0:02:10",
+             "payload": {"tech": "Feudal Age"}},
+            {"type": "BUY", "player": 1, "timestamp": "0:03:00"},
+            {"type": "TRAIN", "player": 2, "timestamp": "0:00:30",
+             "payload": {"unit": "Archer"}, "object_ids": [3]},
+            {"type": "SELL", "player": 2, "timestamp": "0:04:00"},
+        ],
+    }
+    result = analyze_replay(data, you_name="you", you_player=None, export_level="coach")
+    view = result["coach_view"]
+    assert view["timings"]["you"]["ages"]["Feudal"]["click_time"] == 130
+    assert view["first_buildings"]["you"]["times"] == {"barracks": 60}
+    assert view["units"]["you"]["created_totals_by_line"] == {"villager": 1}
+    assert view["units"]["opponent"]["created_totals_by_line"] == {"archer_line": 1}
+    assert view["eco_health"]["you"]["market"]["first_buy"] == 180
+    assert view["eco_health"]["opponent"]["market"]["sell_count"] == 1
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_write_outputs_json_roundtrip(tmp_path, monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(core, "orjson", None)
+    data = {
+        "players": [
+            {"name": "Dé", "civilization": "Franks", "winner": True},
+            {"name": "Opp", "civilization": "Britons", "winner": False},
+        ],
+        "duration": 60,
+        "timestamp": 0,
+        "actions": [],
+    }
+    result = analyze_replay(data, you_name=None, you_player=None, export_level="coach")
+    outputs = write_outputs(result, tmp_path, "header-row")
+    loaded = json.loads(outputs["json"].read_text(encoding="utf-8"))
+    assert loaded["players"]["you"]["name"] == "Dé"
+    assert loaded["coach_view"] == json.loads(json.dumps(result["coach_view"]))